@@ -1,294 +1,484 @@
-# import global modules
-from datetime import date, timedelta
-import boto3
-import fire
-import glob2
-import logging
-import os
-import pandas as pd
-import sqlalchemy
-import sys
-
-
-# import local modules
-import config
-
-from py_modules.create_directories import create_directories
-
-from py_modules.s2_processing import(download_s2_bands,
-                                     resample_s2_bands)
-
-from py_modules.raster_calculations import (calc_veg_indices,
-                                            mosaic_veg_indices,
-                                            upload_veg_indices)
-
-from py_modules.parcel_calculations import(select_parcels,
-                                           calc_zonal_stats,
-                                           upload_parcels_df)
-
-
-# define main function to harvest, calculate and upload
-# sentinel-2 data and information from and to Nexus
-def run_task(input_schema, output_schema, output_table, calc_parcel_stats):
-    """ 
-    This function is created to connect to the Nexus geodatabase,
-    harvest and process Sentinel-2 bands, calculate vegetation indices,
-    calculate grassland parcel statistics for those indices, and
-    upload calculations back to Nexus
-    Function argument(s):
-    - input_schema: the input schema from the Nexus database
-    - output_schema: the output schema from the Nexus database
-    - output_table: the name of the output table to upload to Nexus
-    - calc_parcel_stats: boolean to able or disable parcel stats calculations
-    """
-    ### INITIALIZATION ###
-    # initiate logging settings
-    logging.basicConfig(stream = sys.stdout, level = logging.INFO,
-                        format = ("%(asctime)s - %(name)s - "
-                                  "%(levelname)s - %(message)s"))
-    
-    # connect to the Nexus Database
-    logging.info("Starting the workfow and connecting to Nexus...")
-    db = config.DATABASE
-    url = (f"postgresql://{db['USER']}:{db['PASSWORD']}@{db['HOST']}:"
-           f"{db['PORT']}/{db['NAME']}")
-    engine = sqlalchemy.create_engine(url, client_encoding = "utf8",
-                                      pool_size = 6)
-    
-    # connect to boto3 client
-    s3 = boto3.client("s3", aws_access_key_id = config.ACCESS_KEY_ID,
-                      aws_secret_access_key = config.SECRET_ACCESS_KEY)
-    logging.info(f"Connected to the Nexus Database; "
-                 f"calculation initialized with input schema "
-                 f"{input_schema} and output_schema {output_schema}")
-    
-    # enter start and enddate here in YYYY-MM-DD format or
-    # datetime.today instance for which S2 data should be processed
-    start_date = date.today() - timedelta(days = 2)
-    end_date = date.today() - timedelta(days = 0)
-    
-    # enter maximum cloud cover percentage
-    cloud_cover_perc = 90
-    
-    # create range of dates
-    time_range = pd.date_range(str(start_date), str(end_date))
-    time_range = pd.Series(time_range).dt.date
-    
-    # store s2 band names in list
-    band_names = ["scene_class", "surf_refl_665nm", "surf_refl_705nm",
-                  "surf_refl_783nm", "surf_refl_865nm"]
-    
-    # store vegetation indices in list
-    veg_indices = ["ndvi", "wdvi", "ndre", "ci_red_edge"]
-    
-    
-    ### EXTRACTING TILE GEOMETRIES ###
-    # create data and py modules directories and set data output path
-    create_directories()
-    output_path = "./data"
-    
-    # select all distinct tile geometries (id = 48 and s2 band = 665nm)
-    logging.info("Extracting tile geometries from Nexus...")
-    geom_query = (f"SELECT distinct(polygon) "
-                  f"FROM {input_schema}.raster "
-                  f"WHERE dc_id = 48 and "
-                  f"parameter LIKE '%%{band_names[0]}%%'")
-    
-    # store geometries in dataframe and remove query
-    geom_df = pd.read_sql_query(geom_query, engine)
-    geom_query = None
-    
-    # terminate function if no tile geometries are available
-    if geom_df.empty:
-        logging.info("No tile geometries available. Workflow terminated.")
-        return
-    
-    # else, give message that geometries were extracted
-    # and continue the workflow
-    else:
-        logging.info("Tile geometries extracted.")
-    
-    
-    ### CREATING NESTED LOOP TO PERFORM CALCULATIONS DATE- AND TILE-WISE ###
-    # initialize loop to do calculations for all dates in time range
-    for i in range(len(time_range)):
-        
-        # create date string
-        s2_date = str(time_range[i])
-        
-        # Give message about (next) iteration
-        logging.info("(Next) iteration initiated...")
-        
-        # set range and initialize loop to perform calculations for each tile
-        tile_range = range(len(geom_df)) # run calculations for all tiles
-        # tile_range = range(0, 5) # try calculations for small num of tiles
-        for j in tile_range:
-            
-            # extract tile_geometry for current tile from geom_df
-            tile_geom = list(geom_df.iloc[j])[0]
-            
-            
-            ### HARVESTING SENTINEL-2 IMAGES ###
-            # download selected Sentinel-2 bands
-            logging.info("Searching for Sentinel-2 data and "
-                         "downloading them if available...")
-            tile_id_init, time_stamp_init = download_s2_bands(
-            config = config,
-            input_schema = input_schema,
-            engine = engine,
-            s3 = s3,
-            band_names = band_names,
-            output_path = output_path,
-            s2_date = s2_date,
-            tile_geom = tile_geom)
-            
-            # Give message that no Sentinel-2 data were available
-            if time_stamp_init == None:
-                logging.info("No Sentinel-2 data available for current tile.")
-            
-            
-            ### RESAMPLING AND VEGETATION INDEX CALCULATIONS ###
-            else:
-                # make copy of tile_id and time_stamp variables
-                tile_id, time_stamp = tile_id_init, time_stamp_init
-                
-                # resample s2 bands to 10m
-                logging.info("Sentinel-2 bands downloaded.")
-                logging.info("Resampling Sentinel-2 bands...")
-                resample_s2_bands(output_path = output_path,
-                                  band_names = band_names)
-                logging.info("Sentinel-2 bands resampled.")
-                
-                # calculate and mask vegetation indices
-                logging.info("Masking Sentinel-2 bands and calculating "
-                             "vegetation indices current tile...")
-                calc_veg_indices(output_path = output_path,
-                                 s2_date = s2_date,
-                                 band_names = band_names,
-                                 veg_indices = veg_indices,
-                                 tile_index = j)
-                logging.info("Vegetation indices current tile calculated.")
-                
-                # remove individual sentinel-2 bands from data folder 
-                s2_files = glob2.glob("./data/surf_refl*")
-                s2_files.extend(glob2.glob("./data/s2a_scene_class*"))
-                for f in s2_files:
-                    os.remove(f)
-            
-            
-            ### MOSAICING AND UPLOADING VEGETATION INDEX IMAGES ###
-            veg_ind_tile_files = glob2.glob(f"{output_path}/"
-                                            f"{veg_indices[i]}-"
-                                            f"{s2_date}-*.tif")
-            
-            # initiate last iteration of inner loop body
-            if j == tile_range[-1] and len(veg_ind_tile_files) != 0:
-                
-                # mosaicing the vegetation index tiles into one composite
-                logging.info("Mosaicing vegetation index tiles "
-                             "into one composite...")
-                mosaic_veg_indices(output_path = output_path,
-                                   s2_date = s2_date,
-                                   veg_indices = veg_indices,
-                                   time_stamp = time_stamp)
-                logging.info("Vegetation index tiles mosaiced "
-                             "into one composite.")
-                
-                # upload mosaiced vegetation index images to Nexus
-                logging.info("Uploading vegetation index images to Nexus...")
-                upload_veg_indices(config = config,
-                                   output_schema = output_schema,
-                                   engine = engine,
-                                   s3 = s3,
-                                   output_path = output_path,
-                                   time_stamp = time_stamp,
-                                   veg_indices = veg_indices)
-                logging.info("Vegetation index images uploaded.")
-                
-                
-                ### PARCEL CALCULATIONS ###
-                if calc_parcel_stats == True:
-                    
-                    # select all grassland parcels within study area
-                    # and write to file
-                    logging.info("Searching and selecting grassland parcels "
-                                 "within study area")
-                    parcels, parcels_present = select_parcels(
-                    input_schema = input_schema,
-                    engine = engine,
-                    output_path = output_path,
-                    s2_date = s2_date)
-                    
-                    # give message if no parcels were available
-                    if parcels_present == False:
-                        logging.info("No grassland parcels available "
-                                     "within current tile.")
-                    
-                    # else, calculate zonal statistics and build the dataframe
-                    else:
-                        logging.info("Grassland parcels selected.")
-                        
-                        # calculate zonal statistics
-                        logging.info("Calculating zonal statistics...")
-                        parcel_stats = calc_zonal_stats(
-                        output_path = output_path,
-                        veg_indices = veg_indices,
-                        time_stamp = time_stamp)
-                        logging.info("Zonal statistics calculated.")
-                        
-                        # create new parcels dataframe and upload to Nexus
-                        logging.info("Creating updated parcels dataframe and "
-                                     "if not empty, upload it to Nexus...")
-                        parcels_new = upload_parcels_df(time_stamp =
-                                                        time_stamp,
-                                                        tile_id = tile_id,
-                                                        cloud_cover_perc =
-                                                        cloud_cover_perc,
-                                                        parcels = parcels,
-                                                        parcel_stats =
-                                                        parcel_stats,
-                                                        output_table =
-                                                        output_table,
-                                                        engine = engine,
-                                                        output_schema =
-                                                        output_schema)
-                        
-                        # give messages about uploading information to Nexus
-                        if not parcels_new.empty:
-                            logging.info("Parcel dataframe uploaded.")
-                        
-                        else:
-                            logging.info("Dataframe empty; no new parcel "
-                                         "information uploaded to Nexus.")
-                        
-                        # remove parcel variables
-                        parcels, parcel_stats, parcels_new = None, None, None
-        
-        # empty data folder contents 
-        files = os.listdir(output_path)
-        for f in files:
-            os.remove(f)
-        logging.info("Data folder and variables cleared.")
-    
-    # Give message that workflow was successfully executed
-    logging.info("Workflow successfully executed.")
-
-
-if __name__ == "__main__":
-        
-    if config.DEBUG:
-        # If 'settings.DEBUG' is set to True, Nexus will run provided function
-        # with the arguments below. You could specify different test cases 
-        # here, for example running the script with different input arguments.
-        run_task(input_schema = "knowh2o",
-                 output_schema = "sandbox_sen2grass",
-                 output_table = "parcels_new",
-                 calc_parcel_stats = False)
-    
-    else:
-        # In case 'settings.DEBUG' is False, this script can be run from 
-        # the command line. To try it out, open a command prompt, navigate
-        # to the current directory and run:
-        # <python main.py sandbox sandbox_demo_calculation_python 500 yes True>
-        fire.Fire(run_task)
-    
\ No newline at end of file
+# import global modules
+from concurrent.futures import (ProcessPoolExecutor, wait,
+                                FIRST_COMPLETED)
+from datetime import date, timedelta
+from osgeo import gdal
+import boto3
+import botocore.config
+import fire
+import functools
+import glob
+import logging
+import numba
+import os
+import queue
+import shutil
+import sqlalchemy
+import sys
+import threading
+
+
+# import local modules
+import config
+
+from py_modules.create_directories import create_directories
+
+from py_modules.s2_processing import(download_s2_bands,
+                                     resample_s2_bands)
+
+from py_modules.raster_calculations import (calc_veg_indices,
+                                            mosaic_veg_indices,
+                                            upload_veg_indices)
+
+from py_modules.parcel_calculations import(select_parcels,
+                                           calc_zonal_stats,
+                                           upload_parcels_df)
+
+
+# define lazy singletons for the database engine and boto3 client, so
+# repeated calls reuse the pooled connections instead of paying the
+# TLS and authentication handshake again; under a process pool each
+# worker initializes its own pair exactly once
+@functools.lru_cache(maxsize = 1)
+def get_engine():
+    """
+    Function to lazily create and cache the engine to connect
+    to the Nexus database.
+    """
+    db = config.DATABASE
+    url = (f"postgresql://{db['USER']}:{db['PASSWORD']}@{db['HOST']}:"
+           f"{db['PORT']}/{db['NAME']}")
+    return sqlalchemy.create_engine(url, client_encoding = "utf8",
+                                    pool_size = 16,
+                                    max_overflow = 32,
+                                    pool_pre_ping = True)
+
+
+@functools.lru_cache(maxsize = 1)
+def get_s3():
+    """
+    Function to lazily create and cache the boto3 client to connect
+    to the Nexus S3 bucket.
+    """
+    return boto3.client("s3", config = botocore.config.Config(
+                        max_pool_connections = 64,
+                        retries = {"max_attempts": 10,
+                                   "mode": "adaptive"}),
+                        aws_access_key_id = config.ACCESS_KEY_ID,
+                        aws_secret_access_key = config.SECRET_ACCESS_KEY)
+
+
+# define initializer for the pooled compute workers
+def _init_compute_worker():
+    """
+    Initializer run once in every pooled compute worker. The tiles
+    already run in parallel at the process level, so each worker pins
+    gdal and the numba kernel to a single thread; otherwise every
+    worker would spawn its own thread team and oversubscribe the cores.
+    The worker also shrinks its share of the gdal block cache, so the
+    pool as a whole stays within the 2GB budget of the main process.
+    """
+    gdal.SetConfigOption("GDAL_NUM_THREADS", "1")
+    gdal.SetConfigOption("GDAL_CACHEMAX",
+                         str(max(2048 // os.cpu_count(), 128)))
+    numba.set_num_threads(1)
+
+
+# define producer function to download the sentinel-2 bands of one tile
+def _download_one_tile(j, tile_geom, s2_date, input_schema,
+                       band_names, output_path):
+    """
+    Producer function to download the sentinel-2 bands of one
+    date-tile task into its private scratch directory. The downloads
+    are network-bound, so they run in a thread and overlap with the
+    computations on previously downloaded tiles.
+    Function argument(s):
+    - j: the index number of the current tile in the iteration
+    - tile_geom: a polygon geometry string retrieved from table at Nexus
+    - s2_date: the date for which sentinel-2 bands should be processed
+    - input_schema: the input schema from the Nexus database
+    - band_names: the names of the sentinel-2 bands in a list
+    - output_path: the data directory holding the per-tile sub-directories
+    The function returns the tile id, the time stamp, the band path
+    map and the scratch directory, or None if no data were available.
+    """
+    # create private scratch directory for this date-tile task to
+    # avoid file races between concurrently running tasks
+    tile_path = f"{output_path}/{s2_date}/tile_{j}"
+    create_directories((tile_path,))
+
+    # get the cached engine and boto3 client
+    engine = get_engine()
+    s3 = get_s3()
+
+    # download selected sentinel-2 bands for current tile
+    tile_id, time_stamp, band_paths = download_s2_bands(
+    config = config,
+    input_schema = input_schema,
+    engine = engine,
+    s3 = s3,
+    band_names = band_names,
+    output_path = tile_path,
+    s2_date = s2_date,
+    tile_geom = tile_geom)
+
+    # return nothing if no sentinel-2 data were available
+    if time_stamp == None:
+        return None
+
+    # return tile id, time stamp, band paths and scratch directory
+    return tile_id, time_stamp, band_paths, tile_path
+
+
+# define consumer function to resample and index one downloaded tile
+def _compute_one_tile(j, s2_date, band_names, veg_indices,
+                      tile_path, band_paths):
+    """
+    Worker function to resample the downloaded bands of one tile and
+    calculate its vegetation indices. The work is CPU-bound and
+    pickle-safe, so it runs in the process pool while further tiles
+    are still downloading.
+    Function argument(s):
+    - j: the index number of the current tile in the iteration
+    - s2_date: the date for which sentinel-2 bands should be processed
+    - band_names: the names of the sentinel-2 bands in a list
+    - veg_indices: the names of the vegetation indices in a list
+    - tile_path: the scratch directory holding the downloaded bands
+    - band_paths: dictionary mapping each band name to its downloaded
+      file path
+    """
+    # resample s2 bands to 10m
+    resampled_paths = resample_s2_bands(band_paths = band_paths)
+
+    # calculate and mask vegetation indices
+    calc_veg_indices(output_path = tile_path,
+                     s2_date = s2_date,
+                     band_names = band_names,
+                     veg_indices = veg_indices,
+                     tile_index = j,
+                     band_paths = resampled_paths)
+
+    # remove individual sentinel-2 bands from tile directory using the
+    # collected path maps instead of globbing the directory again
+    for f in list(band_paths.values()) + list(resampled_paths.values()):
+        if os.path.isfile(f):
+            os.remove(f)
+
+
+# define main function to harvest, calculate and upload
+# sentinel-2 data and information from and to Nexus
+def run_task(input_schema, output_schema, output_table, calc_parcel_stats):
+    """
+    This function is created to connect to the Nexus geodatabase,
+    harvest and process Sentinel-2 bands, calculate vegetation indices,
+    calculate grassland parcel statistics for those indices, and
+    upload calculations back to Nexus
+    Function argument(s):
+    - input_schema: the input schema from the Nexus database
+    - output_schema: the output schema from the Nexus database
+    - output_table: the name of the output table to upload to Nexus
+    - calc_parcel_stats: boolean to able or disable parcel stats calculations
+    """
+    ### INITIALIZATION ###
+    # initiate logging settings
+    logging.basicConfig(stream = sys.stdout, level = logging.INFO,
+                        format = ("%(asctime)s - %(name)s - "
+                                  "%(levelname)s - %(message)s"))
+
+    # connect to the Nexus Database and boto3 client through the
+    # lazily cached singletons
+    logging.info("Starting the workfow and connecting to Nexus...")
+    engine = get_engine()
+    s3 = get_s3()
+    logging.info(f"Connected to the Nexus Database; "
+                 f"calculation initialized with input schema "
+                 f"{input_schema} and output_schema {output_schema}")
+
+    # enter start and enddate here in YYYY-MM-DD format or
+    # datetime.today instance for which S2 data should be processed
+    start_date = date.today() - timedelta(days = 2)
+    end_date = date.today() - timedelta(days = 0)
+
+    # enter maximum cloud cover percentage
+    cloud_cover_perc = 90
+
+    # count the number of days in the processing window
+    num_days = (end_date - start_date).days + 1
+
+    # store s2 band names in list
+    band_names = ["scene_class", "surf_refl_665nm", "surf_refl_705nm",
+                  "surf_refl_783nm", "surf_refl_865nm"]
+
+    # store vegetation indices in list
+    veg_indices = ["ndvi", "wdvi", "ndre", "ci_red_edge"]
+
+
+    ### EXTRACTING TILE GEOMETRIES ###
+    # create data and py modules directories and set data output path
+    create_directories()
+    output_path = "./data"
+
+    # maintain a small materialized view holding the distinct tile
+    # geometries (id = 48 and s2 band = 665nm); the expensive DISTINCT
+    # over the large raster table then only runs when the view is
+    # (re)created, not on every invocation. Refreshing the view is left
+    # to a scheduled REFRESH MATERIALIZED VIEW on the database side
+    logging.info("Extracting tile geometries from Nexus...")
+    geom_view = f"{input_schema}.tile_geoms_mv"
+    geom_view_query = (f"CREATE MATERIALIZED VIEW IF NOT EXISTS "
+                       f"{geom_view} AS "
+                       f"SELECT distinct(polygon) "
+                       f"FROM {input_schema}.raster "
+                       f"WHERE dc_id = 48 and "
+                       f"parameter LIKE '%%{band_names[0]}%%'")
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text(geom_view_query))
+
+    # select all tile geometries from the view and fetch them as a
+    # plain list of rows; a dataframe is overkill for a single
+    # geometry column
+    geom_query = f"SELECT polygon FROM {geom_view}"
+    with engine.connect() as connection:
+        geom_rows = connection.execute(
+        sqlalchemy.text(geom_query)).fetchall()
+    geom_query = None
+
+    # terminate function if no tile geometries are available
+    if not geom_rows:
+        logging.info("No tile geometries available. Workflow terminated.")
+        return
+
+    # else, give message that geometries were extracted
+    # and continue the workflow
+    else:
+        logging.info("Tile geometries extracted.")
+
+
+    ### HARVESTING AND PROCESSING THE DATE-TILE GRID IN PARALLEL ###
+    # create list of date strings with native date arithmetic
+    s2_dates = [(start_date + timedelta(days = n)).isoformat()
+                for n in range(num_days)]
+
+    # set range of tiles to process
+    tile_range = range(len(geom_rows)) # run calculations for all tiles
+    # tile_range = range(0, 5) # try calculations for small num of tiles
+
+    # overlap network and compute through a bounded producer/consumer
+    # queue: a downloader thread streams the date x tile grid into the
+    # queue while the process pool consumes and indexes the downloaded
+    # tiles, so wall-clock approaches max(download, compute) instead
+    # of their sum. The queue bound caps the staged bands on disk
+    logging.info("Searching for Sentinel-2 data and processing "
+                 "available date-tile combinations in parallel...")
+    results_by_date = {s2_date: [] for s2_date in s2_dates}
+    task_queue = queue.Queue(maxsize = 4)
+
+    # define downloader that feeds the queue and marks the end of the
+    # grid with a sentinel value; a raised download error is recorded
+    # and the sentinel is still enqueued, so the consumer loop below
+    # can never block forever on an empty queue
+    downloader_errors = []
+    def _downloader():
+        try:
+            for s2_date in s2_dates:
+                for j in tile_range:
+                    download = _download_one_tile(j,
+                                                  geom_rows[j][0],
+                                                  s2_date,
+                                                  input_schema,
+                                                  band_names,
+                                                  output_path)
+                    if download != None:
+                        task_queue.put((j, s2_date, download))
+        except BaseException as error:
+            downloader_errors.append(error)
+        finally:
+            task_queue.put(None)
+
+    # start the downloader thread as a daemon, so a consumer error
+    # while the queue is full cannot leave a blocked producer thread
+    # keeping the interpreter alive
+    downloader = threading.Thread(target = _downloader, daemon = True)
+    downloader.start()
+
+    # consume the queue and dispatch the CPU-bound tile computations
+    # to the process pool
+    with ProcessPoolExecutor(max_workers = os.cpu_count(),
+                             initializer = _init_compute_worker
+                             ) as executor:
+        compute_futures = []
+        while True:
+            item = task_queue.get()
+            if item == None:
+                break
+            j, s2_date, download = item
+            tile_id, time_stamp, band_paths, tile_path = download
+            results_by_date[s2_date].append((tile_id, time_stamp))
+
+            # keep only a small backlog of compute tasks in flight so
+            # the downloads cannot run far ahead of the computations;
+            # surface the result of every completed future before
+            # dropping it, so worker errors are not silently swallowed
+            if len(compute_futures) >= os.cpu_count() + 4:
+                done_futures, pending_futures = wait(
+                compute_futures, return_when = FIRST_COMPLETED)
+                for future in done_futures:
+                    future.result()
+                compute_futures = list(pending_futures)
+            compute_futures.append(executor.submit(_compute_one_tile,
+                                                   j,
+                                                   s2_date,
+                                                   band_names,
+                                                   veg_indices,
+                                                   tile_path,
+                                                   band_paths))
+
+        # wait for the remaining computations to finish
+        for future in compute_futures:
+            future.result()
+    downloader.join()
+
+    # re-raise a recorded download error in the main thread, so the
+    # run fails loudly instead of mosaicking incomplete results
+    if downloader_errors:
+        raise downloader_errors[0]
+    logging.info("Date-tile grid processed.")
+
+
+    ### CREATING LOOP TO MOSAIC AND UPLOAD RESULTS DATE-WISE ###
+    for s2_date in s2_dates:
+
+        # keep the results of tiles for which data were available
+        tile_results = results_by_date[s2_date]
+
+        # Give message if no sentinel-2 data were available at all
+        if len(tile_results) == 0:
+            logging.info(f"No Sentinel-2 data available for {s2_date}.")
+
+        else:
+            # extract tile id and time stamp from the last processed tile
+            tile_id, time_stamp = tile_results[-1]
+
+
+        ### MOSAICING AND UPLOADING VEGETATION INDEX IMAGES ###
+        veg_ind_tile_files = glob.glob(f"{output_path}/**/"
+                                       f"{veg_indices[0]}-"
+                                       f"{s2_date}-*.tif",
+                                       recursive = True)
+
+        # initiate mosaicing if vegetation index tiles are available
+        if len(tile_results) != 0 and len(veg_ind_tile_files) != 0:
+
+            # mosaicing the vegetation index tiles into one composite
+            logging.info("Mosaicing vegetation index tiles "
+                         "into one composite...")
+            mosaic_paths = mosaic_veg_indices(output_path = output_path,
+                                              s2_date = s2_date,
+                                              veg_indices = veg_indices,
+                                              time_stamp = time_stamp)
+            logging.info("Vegetation index tiles mosaiced "
+                         "into one composite.")
+
+            # upload mosaiced vegetation index images to Nexus
+            logging.info("Uploading vegetation index images to Nexus...")
+            upload_veg_indices(config = config,
+                               output_schema = output_schema,
+                               engine = engine,
+                               s3 = s3,
+                               veg_indices = veg_indices,
+                               mosaic_paths = mosaic_paths)
+            logging.info("Vegetation index images uploaded.")
+
+
+            ### PARCEL CALCULATIONS ###
+            if calc_parcel_stats == True:
+
+                # select all grassland parcels within study area
+                # and write to file
+                logging.info("Searching and selecting grassland parcels "
+                             "within study area")
+                parcels, parcels_present = select_parcels(
+                input_schema = input_schema,
+                engine = engine,
+                output_path = output_path,
+                s2_date = s2_date)
+
+                # give message if no parcels were available
+                if parcels_present == False:
+                    logging.info("No grassland parcels available "
+                                 "within current tile.")
+
+                # else, calculate zonal statistics and build the dataframe
+                else:
+                    logging.info("Grassland parcels selected.")
+
+                    # calculate zonal statistics
+                    logging.info("Calculating zonal statistics...")
+                    parcel_stats = calc_zonal_stats(
+                    output_path = output_path,
+                    veg_indices = veg_indices,
+                    mosaic_paths = mosaic_paths)
+                    logging.info("Zonal statistics calculated.")
+
+                    # create new parcels dataframe and upload to Nexus
+                    logging.info("Creating updated parcels dataframe and "
+                                 "if not empty, upload it to Nexus...")
+                    parcels_new = upload_parcels_df(time_stamp =
+                                                    time_stamp,
+                                                    tile_id = tile_id,
+                                                    cloud_cover_perc =
+                                                    cloud_cover_perc,
+                                                    parcels = parcels,
+                                                    parcel_stats =
+                                                    parcel_stats,
+                                                    output_table =
+                                                    output_table,
+                                                    engine = engine,
+                                                    output_schema =
+                                                    output_schema)
+
+                    # give messages about uploading information to Nexus
+                    if not parcels_new.empty:
+                        logging.info("Parcel dataframe uploaded.")
+
+                    else:
+                        logging.info("Dataframe empty; no new parcel "
+                                     "information uploaded to Nexus.")
+
+                    # remove parcel variables
+                    parcels, parcel_stats, parcels_new = None, None, None
+
+            # remove the uploaded mosaic composites and parcel file
+            # of the current date
+            for mosaic_file in mosaic_paths.values():
+                if os.path.isfile(mosaic_file):
+                    os.remove(mosaic_file)
+            parcels_file = f"{output_path}/parcels.geojson"
+            if os.path.isfile(parcels_file):
+                os.remove(parcels_file)
+
+        # empty the scratch directory of the current date in one pass
+        shutil.rmtree(f"{output_path}/{s2_date}", ignore_errors = True)
+        logging.info("Data folder and variables cleared.")
+
+    # Give message that workflow was successfully executed
+    logging.info("Workflow successfully executed.")
+
+
+if __name__ == "__main__":
+
+    if config.DEBUG:
+        # If 'settings.DEBUG' is set to True, Nexus will run provided function
+        # with the arguments below. You could specify different test cases
+        # here, for example running the script with different input arguments.
+        run_task(input_schema = "knowh2o",
+                 output_schema = "sandbox_sen2grass",
+                 output_table = "parcels_new",
+                 calc_parcel_stats = False)
+
+    else:
+        # In case 'settings.DEBUG' is False, this script can be run from
+        # the command line. To try it out, open a command prompt, navigate
+        # to the current directory and run:
+        # <python main.py sandbox sandbox_demo_calculation_python 500 yes True>
+        fire.Fire(run_task)
@@ -1,13 +1,15 @@
-# import modules
-import os
-
-# define function(s)
-def create_directories():
-    """
-    Function to create local directories to store data and python modules.
-    """
-    folders = ["data", "py_modules"]
-    for i in range(len(folders)):
-        path = f"./{folders[i]}"
-        if not os.path.isdir(path):
-            os.mkdir(path)
\ No newline at end of file
+# import modules
+import os
+
+# define function(s)
+def create_directories(folders = ("data", "py_modules")):
+    """
+    Function to create local directories to store data and python modules.
+    Function argument(s):
+    - folders: the directories to create, relative to the working
+      directory
+    """
+    # makedirs with exist_ok avoids the check-then-create race when
+    # concurrent workers provision their scratch directories
+    for folder in folders:
+        os.makedirs(f"./{folder}", exist_ok = True)
@@ -1,148 +1,276 @@
-# import modules
-import geopandas as gpd
-import glob2
-import numpy as np
-import os
-import pandas as pd
-from rasterstats import zonal_stats
-
-
-# define functions
-def select_parcels(input_schema, engine, output_path, s2_date):
-    """
-    Function to select all grassland parcels in on s2 tile and 
-    store them in geodataframe, and as a geojson in the data directory.
-    Function argument(s):
-    - input_schema: the input schema from the Nexus database
-      where the tables are stored
-    - engine: an engine to connect to a sql database
-    - output_path: the image path where the sentinel-2 bands should be stored
-    - s2_date: a date for which calculation were performed on s2 data
-    """
-    # define query to select all grassland parcels within
-    # study area and store them in geodataframe (try for max. 500 parcels)
-    parcel_query = (f"SELECT id, id_src, polygon, vegetation_type "
-                    f"FROM {input_schema}.plant_cover "
-                    f"WHERE vegetation_type = 'pasture' and "
-                    f"end_date > date '{s2_date}' - INTERVAL '1 year' "
-                    f"LIMIT 500")
-    
-    # store records in dataframe
-    parcel_gdf = gpd.GeoDataFrame.from_postgis(parcel_query,
-                                               engine,
-                                               geom_col = "polygon")
-    
-    # write parcel dataframe to file and set parcels_present to True
-    parcels_file = f"{output_path}/parcels.geojson"
-    if not parcel_gdf.empty and not os.path.isfile(parcels_file):
-        parcel_gdf.to_file(parcels_file, driver = "GeoJSON")
-        parcels_present = True
-        
-    # set parcels_present to False if no parcels are present
-    else:
-        parcels_present = False
-    
-    # remove query
-    parcel_query = None
-    
-    # return dataframe and boolean
-    return parcel_gdf, parcels_present
-
-
-def calc_zonal_stats(output_path, veg_indices, time_stamp):
-    """
-    Function to calculate zonal statistics for all grassland parcels within 
-    one sentinel tile, including veg index mean and std. and cloud cover %
-    and store them in a pandas data frame.
-    Function arguments:
-    - output_path: the image path where the sentinel-2 bands are stored
-    - veg_indices: a list with vegetation indices (NDVI, WDVI,
-                                                   NDRE, CI_Red_Edge)
-    - time_stamp: date and time for which calculations were performed
-      (in <YYYY><MM><DD> format)
-    """
-    # initiate loop to iterate over all four indices
-    for i in range(len(veg_indices)):
-        
-        # set input files
-        vector_file = f"{output_path}/parcels.geojson"
-        raster_file = glob2.glob(f"{output_path}/*{time_stamp}*"
-                                 f"{veg_indices[i]}*.tif")[0]
-        
-        # calculate zonal statistics
-        stats = zonal_stats(vectors = vector_file,
-                            raster = raster_file,
-                            nodata = np.nan,
-                            stats = ["mean", "std", "count", "nan"],
-                            all_touched = False)
-        
-        # store data in dataframe
-        stats_df = pd.DataFrame(stats)
-        mean_std = stats_df[["mean", "std"]]
-        mean_std.columns = [f"{veg_indices[i]}_mean",
-                            f"{veg_indices[i]}_std"]
-        
-        # calculate cloud cover percentage and concatenate to main df
-        if i == 0:
-            cloud_cover = pd.DataFrame(stats_df["nan"] / 
-            (stats_df["count"] + stats_df["nan"]) * 100)
-            cloud_cover.columns = ["cloud_cover_perc"]
-            parcel_stats = pd.concat([cloud_cover, mean_std], axis = 1)
-        
-        # concatenate dataframes together
-        else:
-            parcel_stats = pd.concat([parcel_stats, mean_std], axis = 1)
-        
-        # remove variables
-        stats, mean_std, cloud_cover = None, None, None
-        
-    # return the dataframe
-    return parcel_stats
-
-
-def upload_parcels_df(time_stamp, tile_id, cloud_cover_perc, parcels,
-                      parcel_stats, output_table, engine, output_schema):
-    """
-    Function to upload and append new parcels dataframe containing
-    zonal statistics calculations to Nexus.
-    Function argument(s):
-    - time_stamp: a tile stamp value retrieved from table at Nexus server
-    - tile_id: a tile id value retrieved from table at Nexus server
-    - cloud_cover_perc: the maximum chosen cloud cover percentage
-    - parcels: the original parcels dataframe retrieved from Nexus server
-    - parcel_stats: the calculated parcels statistics in a dataframe
-    - output_table: the name of the output table to upload to Nexus
-    - engine: an engine to connect to a sql database
-    - output_schema: the output schema from the Nexus database
-    """
-    # create time_stamp series
-    time_stamp_col = pd.DataFrame([time_stamp] * parcels.shape[0])
-    time_stamp_col.columns = ["time_stamp"]
-    
-    # create tile_id series
-    tile_id_col = pd.DataFrame([tile_id] * parcels.shape[0])
-    tile_id_col.columns = ["tile_id"]
-    
-    # concatenate all dataframes into one large dataframe
-    parcels_new_df = pd.concat([parcels["id"],
-                                parcels["id_src"],
-                                tile_id_col,
-                                time_stamp_col,
-                                parcels["vegetation_type"],
-                                parcel_stats], axis = 1)
-    
-    # remove records that contain more cloud cover than given percentage
-    parcels_new_df = parcels_new_df.drop(parcels_new_df[
-    parcels_new_df["cloud_cover_perc"] >= cloud_cover_perc].index)
-    
-    # if dataframe contains information, upload it to Nexus server
-    if not parcels_new_df.empty:
-        parcels_new_df.to_sql(output_table, engine,
-                              schema = output_schema,
-                              if_exists = "append")
-    
-    # remove variables
-    time_stamp_col, tile_id_col = None, None
-    
-    # return new parcel dataframe
+# import modules
+from io import StringIO
+from numba import njit
+from rasterio.features import rasterize
+import json
+import numpy as np
+import os
+import pandas as pd
+import rasterio
+import sqlalchemy
+
+
+# define compiled kernel to aggregate statistics per parcel label;
+# no fastmath here, because its no-nan assumption would let llvm fold
+# away the isnan test that the nodata accounting depends on
+@njit(cache = True)
+def _parcel_stats_kernel(labels, values, num_parcels):
+    """
+    Compiled kernel to calculate mean, std, pixel count and nodata
+    count per parcel label in one fused pass over the masked pixels,
+    instead of separate group-by passes with temporary arrays.
+    Function argument(s):
+    - labels: flat int32 array with the zero-based parcel label
+      of each masked pixel
+    - values: flat float32 array with the vegetation index value
+      of each masked pixel (nodata as nan)
+    - num_parcels: the total number of parcels
+    """
+    sums = np.zeros(num_parcels, np.float64)
+    sq_sums = np.zeros(num_parcels, np.float64)
+    counts = np.zeros(num_parcels, np.int64)
+    nans = np.zeros(num_parcels, np.int64)
+
+    # accumulate sums, squared sums and counts per label
+    for i in range(values.size):
+        label = labels[i]
+        value = values[i]
+        if np.isnan(value):
+            nans[label] += 1
+        else:
+            sums[label] += value
+            sq_sums[label] += value * value
+            counts[label] += 1
+
+    # derive mean and std from the accumulated sums; clamp the
+    # variance at zero, because cancellation can push it slightly
+    # negative for uniform parcels and sqrt would then return nan
+    means = sums / counts
+    stds = np.sqrt(np.maximum(sq_sums / counts - means * means, 0.0))
+    return means, stds, counts, nans
+
+
+# define functions
+def select_parcels(input_schema, engine, output_path, s2_date):
+    """
+    Function to select all grassland parcels in on s2 tile and
+    store them in dataframe, and as a geojson in the data directory.
+    Function argument(s):
+    - input_schema: the input schema from the Nexus database
+      where the tables are stored
+    - engine: an engine to connect to a sql database
+    - output_path: the image path where the sentinel-2 bands should be stored
+    - s2_date: a date for which calculation were performed on s2 data
+    """
+    # define query that aggregates the grassland parcels within the
+    # study area into one geojson feature collection server-side
+    # (try for max. 500 parcels)
+    parcel_query = (f"SELECT jsonb_build_object("
+                    f"'type', 'FeatureCollection', "
+                    f"'features', jsonb_agg(jsonb_build_object("
+                    f"'type', 'Feature', "
+                    f"'geometry', ST_AsGeoJSON(polygon)::jsonb, "
+                    f"'properties', jsonb_build_object("
+                    f"'id', id, 'id_src', id_src, "
+                    f"'vegetation_type', vegetation_type)))) "
+                    f"FROM (SELECT id, id_src, polygon, vegetation_type "
+                    f"FROM {input_schema}.plant_cover "
+                    f"WHERE vegetation_type = 'pasture' and "
+                    f"end_date > date %(s2_date)s - INTERVAL '1 year' "
+                    f"LIMIT 500) AS parcels")
+
+    # fetch the aggregated feature collection through a server-side
+    # cursor, so the parcel records stream on the database side
+    # instead of materializing in an intermediate geodataframe
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor(name = "parcels_cursor") as cursor:
+            cursor.itersize = 10000
+            cursor.execute(parcel_query, {"s2_date": s2_date})
+            (parcels_geojson,) = cursor.fetchone()
+    finally:
+        connection.close()
+
+    # extract the features; jsonb_agg returns null when no parcels
+    # matched the query
+    if parcels_geojson != None:
+        features = parcels_geojson["features"]
+    else:
+        features = None
+
+    # write feature collection as geojson to file and
+    # set parcels_present to True
+    parcels_file = f"{output_path}/parcels.geojson"
+    if features != None and not os.path.isfile(parcels_file):
+        with open(parcels_file, "w") as f:
+            json.dump(parcels_geojson, f)
+        parcels_present = True
+
+    # set parcels_present to False if no parcels are present
+    else:
+        parcels_present = False
+
+    # build a lightweight dataframe with the parcel attributes from
+    # the feature properties; downstream calculations do not need
+    # the geometries
+    parcel_columns = ["id", "id_src", "vegetation_type"]
+    if features != None:
+        parcel_df = pd.DataFrame([feature["properties"]
+                                  for feature in features],
+                                 columns = parcel_columns)
+    else:
+        parcel_df = pd.DataFrame(columns = parcel_columns)
+
+    # remove query
+    parcel_query = None
+
+    # return dataframe and boolean
+    return parcel_df, parcels_present
+
+
+def calc_zonal_stats(output_path, veg_indices, mosaic_paths):
+    """
+    Function to calculate zonal statistics for all grassland parcels within 
+    one sentinel tile, including veg index mean and std. and cloud cover %
+    and store them in a pandas data frame.
+    Function arguments:
+    - output_path: the image path where the sentinel-2 bands are stored
+    - veg_indices: a list with vegetation indices (NDVI, WDVI,
+                                                   NDRE, CI_Red_Edge)
+    - mosaic_paths: dictionary mapping each vegetation index to its
+      mosaic file path, as returned by mosaic_veg_indices
+    """
+    # set column names and preallocate one output array holding the
+    # cloud cover percentage plus mean and std per vegetation index
+    stats_cols = (["cloud_cover_perc"] +
+                  [f"{vi}_{stat}" for vi in veg_indices
+                   for stat in ("mean", "std")])
+
+    # load the parcel features once from the geojson file
+    vector_file = f"{output_path}/parcels.geojson"
+    with open(vector_file) as f:
+        features = json.load(f)["features"]
+    num_parcels = len(features)
+
+    # read the grid layout from the first mosaic; all four mosaics
+    # share the same grid
+    with rasterio.open(mosaic_paths[veg_indices[0]]) as ref_file:
+        ref_transform = ref_file.transform
+        ref_shape = ref_file.shape
+
+    # rasterize the parcel geometries once into an int32 label array
+    # and reuse it for all four vegetation indices, instead of
+    # rasterizing the same polygons per index
+    labels = rasterize(((feature["geometry"], label + 1)
+                        for label, feature in enumerate(features)),
+                       out_shape = ref_shape,
+                       transform = ref_transform,
+                       fill = 0,
+                       dtype = np.int32)
+    label_mask = labels > 0
+    flat_labels = labels[label_mask] - 1
+
+    # allocate the output array
+    stats_arr = np.empty((num_parcels, len(stats_cols)),
+                         dtype = np.float32)
+
+    # initiate loop to iterate over all four indices
+    for i in range(len(veg_indices)):
+
+        # read the masked pixel values of the current index, convert
+        # nodata values to nan and dequantize the scaled int16 values
+        # back to physical index values
+        with rasterio.open(mosaic_paths[veg_indices[i]]) as raster_file:
+            values = (raster_file.read(1)[label_mask].
+                      astype(np.float32))
+        values[values == -32768] = np.nan
+        values *= np.float32(1e-4)
+
+        # aggregate mean, std and counts per parcel label in one
+        # fused compiled pass over the masked pixels
+        means, stds, counts, nans = _parcel_stats_kernel(
+        flat_labels, values, num_parcels)
+
+        # calculate the cloud cover percentage on the first iteration
+        if i == 0:
+            stats_arr[:, 0] = nans / (counts + nans) * 100
+
+        # fill the mean and std columns for the current index
+        stats_arr[:, 1 + 2 * i] = means
+        stats_arr[:, 2 + 2 * i] = stds
+
+    # store the array in a dataframe and return it
+    parcel_stats = pd.DataFrame(stats_arr, columns = stats_cols)
+    return parcel_stats
+
+
+def upload_parcels_df(time_stamp, tile_id, cloud_cover_perc, parcels,
+                      parcel_stats, output_table, engine, output_schema):
+    """
+    Function to upload and append new parcels dataframe containing
+    zonal statistics calculations to Nexus.
+    Function argument(s):
+    - time_stamp: a tile stamp value retrieved from table at Nexus server
+    - tile_id: a tile id value retrieved from table at Nexus server
+    - cloud_cover_perc: the maximum chosen cloud cover percentage
+    - parcels: the original parcels dataframe retrieved from Nexus server
+    - parcel_stats: the calculated parcels statistics in a dataframe
+    - output_table: the name of the output table to upload to Nexus
+    - engine: an engine to connect to a sql database
+    - output_schema: the output schema from the Nexus database
+    """
+    # build the new parcels dataframe in one pass from a dict of
+    # arrays; the constant tile id and time stamp columns are
+    # broadcast instead of built as per-row python lists
+    num_parcels = parcels.shape[0]
+    parcels_new_df = pd.DataFrame({
+    "id": parcels["id"].to_numpy(),
+    "id_src": parcels["id_src"].to_numpy(),
+    "tile_id": np.full(num_parcels, tile_id),
+    "time_stamp": np.full(num_parcels, time_stamp),
+    "vegetation_type": parcels["vegetation_type"].to_numpy()})
+    parcels_new_df = pd.concat([parcels_new_df,
+                                parcel_stats.reset_index(drop = True)],
+                               axis = 1)
+
+    # remove records that contain more cloud cover than given
+    # percentage with a boolean mask; the negated comparison keeps
+    # rows with nan cloud cover, matching the former drop-based filter
+    parcels_new_df = parcels_new_df[
+    ~(parcels_new_df["cloud_cover_perc"] >= cloud_cover_perc)]
+
+    # if dataframe contains information, upload it to Nexus server
+    if not parcels_new_df.empty:
+
+        # let to_sql create the output table on the very first upload,
+        # without the dataframe index so the table schema matches the
+        # column list written by the COPY path below
+        if not sqlalchemy.inspect(engine).has_table(
+        output_table, schema = output_schema):
+            parcels_new_df.to_sql(output_table, engine,
+                                  schema = output_schema,
+                                  if_exists = "append",
+                                  index = False,
+                                  method = "multi",
+                                  chunksize = 1000)
+
+        # else, stream the dataframe into the table with postgresql
+        # COPY, which is far faster than executemany inserts
+        else:
+            csv_buffer = StringIO()
+            parcels_new_df.to_csv(csv_buffer, index = False,
+                                  header = False, na_rep = "\\N")
+            csv_buffer.seek(0)
+            copy_query = (f"COPY {output_schema}.{output_table} "
+                          f"({', '.join(parcels_new_df.columns)}) "
+                          f"FROM STDIN WITH CSV NULL E'\\\\N'")
+            connection = engine.raw_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(copy_query, csv_buffer)
+                connection.commit()
+            finally:
+                connection.close()
+
+    # return new parcel dataframe
     return parcels_new_df
\ No newline at end of file
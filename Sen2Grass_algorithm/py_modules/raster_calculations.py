@@ -1,199 +1,334 @@
-from osgeo import gdal
-import glob2
-import numpy as np
-import os
-
-
-def calc_veg_indices(output_path, s2_date, band_names,
-                     veg_indices, tile_index):
-    """
-    This function masks the downloaded sentinel-2 bands,
-    calculates a number of vegetation images (NDVI, WDVI, NDRE, CI_Red_Edge)
-    using the s2 bands as input, and stores them in the data output folder.
-    Function argument(s):
-    - output_path: the directory where the sentinel-2 bands are stored
-    - s2_date = the date for which calculations should be performed
-    - band_names: the names of the bands in a list ("scene_class",
-                                                    "surf_refl_665nm",
-                                                    "surf_refl_705nm",
-                                                    "surf_refl_783nm",
-                                                    "surf_refl_865nm")
-    - veg_indices: the names of the vegetation indices
-    - tile_index: the index number of the current tile in the iteration
-    """
-    # set how numpy floating-point errors should be handled
-    np.seterr(divide = "ignore", invalid = "ignore")
-    
-    # create empty dictionary to store sentinel-2 bands and
-    # initiate loop to iterate through bands
-    s2_dict = {}
-    for i in range(len(band_names)):
-        
-        # set file path and read raster file as array with float values
-        file_path = glob2.glob(os.path.join(output_path,
-                                            f"*{band_names[i]}"
-                                            f"*{s2_date}*10m.tif"))[0]
-        gdal_file = gdal.Open(file_path)
-        gdal_band = gdal_file.GetRasterBand(1)
-        s2_dict[f"{band_names[i]}"] = (gdal_band.ReadAsArray().
-                                       astype(np.float32))
-        
-        # calculations for SCL band
-        if band_names[i] == "scene_class":
-            
-            # set up coordinate reference system for output GeoTIFF
-            geo_trans = gdal_file.GetGeoTransform()
-            proj_info = gdal_file.GetProjection()
-            
-            # convert SCL band categories such as cloud cover to NA
-            s2_dict["scene_class"][np.logical_or(s2_dict["scene_class"] < 1,
-            np.logical_and(s2_dict["scene_class"] > 7,
-                           s2_dict["scene_class"] < 10))] = np.nan
-            
-            # convert SCL band categories such as land and vegetation to 1
-            s2_dict["scene_class"][np.logical_or(s2_dict["scene_class"] >= 10,
-            np.logical_and(s2_dict["scene_class"] >= 1,
-                           s2_dict["scene_class"] <= 7))] = 1
-        
-        # calculations for optical bands
-        else:
-            
-            # divide pixel values of optical bands in by quantification value
-            # of 10000 to convert digital numbers into reflectance values
-            s2_dict[f"{band_names[i]}"] = s2_dict[f"{band_names[i]}"] / 10000
-            
-            # mask the optical bands with SCL band
-            s2_dict[f"{band_names[i]}"] = (s2_dict[f"{band_names[i]}"] *
-                                           s2_dict["scene_class"])
-        
-        # remove gdal variables
-        gdal.Unlink(file_path)
-        gdal_file, gdal_band = None, None
-    
-    # create empty dictionary to store vegetation index rasters
-    veg_ind_dict = {}
-    
-    # calculate ndvi
-    veg_ind_dict[f"{veg_indices[0]}"] = ((s2_dict["surf_refl_865nm"] -
-                                          s2_dict["surf_refl_665nm"]) /
-                                         (s2_dict["surf_refl_865nm"] +
-                                          s2_dict["surf_refl_665nm"]))
-    
-    # calculate wdvi
-    veg_ind_dict[f"{veg_indices[1]}"] = (s2_dict["surf_refl_865nm"] -
-                                         1.8 * s2_dict["surf_refl_665nm"])
-    
-    # calculate ndre
-    veg_ind_dict[f"{veg_indices[2]}"] = ((s2_dict["surf_refl_865nm"] -
-                                          s2_dict["surf_refl_705nm"]) /
-                                         (s2_dict["surf_refl_865nm"] +
-                                          s2_dict["surf_refl_705nm"]))
-    
-    # calculate ci_red_edge
-    veg_ind_dict[f"{veg_indices[3]}"] = (s2_dict["surf_refl_783nm"] /
-                                         s2_dict["surf_refl_705nm"] - 1)
-    
-    # remove Sentinel-2 bands dictionary
-    s2_dict = None
-    
-    # initiate loop to store each vegetation image as file
-    for i in range(len(veg_ind_dict)):
-        
-        # get vegetation index raster from dictionary
-        veg_ind_ras = list(veg_ind_dict.values())[i]
-        
-        # remove outliers and set no data value to -9999
-        veg_ind_ras[np.logical_or(veg_ind_ras < -10,
-                                  veg_ind_ras > 10)] = -9999
-        veg_ind_ras[np.isnan(veg_ind_ras)] = -9999
-        
-        # create vegetation index output file name
-        veg_ind_out_file = (f"{output_path}/{veg_indices[i]}-"
-                            f"{s2_date}-{tile_index}.tif")
-        
-        # perform processing if vegetation image does not exist
-        if not os.path.isfile(veg_ind_out_file):
-            
-            # set number of pixels in x and y
-            x_pixels = veg_ind_ras.shape[1]
-            y_pixels = veg_ind_ras.shape[0]
-            
-            # create driver using driver name, output file name,
-            # x and y pixels, number of bands and datatype
-            driver = gdal.GetDriverByName("GTiff")
-            index_data = driver.Create(utf8_path = veg_ind_out_file,
-                                       xsize = x_pixels,
-                                       ysize = y_pixels,
-                                       bands = 1,
-                                       eType = gdal.GDT_Float32,
-                                       options = ["COMPRESS=LZW"])
-            
-            # Set vegetation index array as output raster band
-            index_data.GetRasterBand(1).WriteArray(veg_ind_ras)
-            
-            # set GeoTransform parameters and projection on
-            # the output file, close data file and remove variables
-            index_data.SetGeoTransform(geo_trans) 
-            index_data.SetProjection(proj_info)
-            index_data.FlushCache()
-            index_data = None
-
-
-def mosaic_veg_indices(output_path, s2_date, veg_indices, time_stamp):
-    """
-    Function to merge a number of input rasters into one composite image.
-    Function argument(s):
-    - output_path: the directory where the sentinel-2 bands are stored
-    - s2_date = the date for which calculations should be performed
-    - veg_indices: the names of the vegetation indices in a list
-    - time_stamp: date and time for which calculations were performed
-      (in <YYYY><MM><DD> format)
-    """
-    # initiate loop to iterate over the four vegetation indices
-    for i in range(len(veg_indices)):
-                    
-        # create path name to search for vegetation index images
-        veg_ind_in_files = glob2.glob(f"{output_path}/{veg_indices[i]}-"
-                                      f"{s2_date}-*.tif")
-        
-        # create path names for geotiff and vrt output files
-        veg_ind_vrt = (f"{output_path}/{time_stamp}-{veg_indices[i]}.vrt")
-        veg_ind_out_tiff = veg_ind_vrt.replace(".vrt", ".tif")
-        
-        # create virtual mosaic from input rasters
-        gdal.BuildVRT(destName = veg_ind_vrt,
-                      srcDSOrSrcDSTab = veg_ind_in_files,
-                      srcNodata = -9999,
-                      VRTNodata = -9999)
-        
-        # store the mosaic as GeoTIFF in output folder
-        gdal.Translate(destName = veg_ind_out_tiff,
-                       srcDS = veg_ind_vrt,
-                       format = "GTiff",
-                       creationOptions = ["COMPRESS=LZW"])
-
-
-def upload_veg_indices(config, output_schema, engine, s3,
-                       output_path, time_stamp, veg_indices):
-    """
-    Function to uplaad calculated vegetation indices to Nexus.
-    Function argument(s):
-    - config: a configuration file
-    - output_schema: the output schema from the Nexus database
-      where the tables are stored
-    - engine: an engine to connect to a sql database
-    - s3: variable for connection with boto3 client
-    - output_path: the image path where the sentinel-2 bands are stored
-    - time_stamp: date and time for which calculations were performed
-      (in <YYYY><MM><DD> format)
-    - veg_indices: a list with vegetation indices (NDVI, WDVI,
-                                                   NDRE, CI_Red_Edge)
-    """
-    for i in range(len(veg_indices)):
-        file_path = glob2.glob(f"{output_path}/{time_stamp}-"
-                               f"{veg_indices[i]}*.tif")[0]
-        file_name = os.path.basename(file_path)
-        if os.path.isfile(file_path):
-            with open(file_path, "rb") as f:
-                s3.upload_fileobj(f, config.BUCKET,
-                                  f"{output_schema}/raster/{file_name}")
\ No newline at end of file
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit, prange
+from osgeo import gdal
+from py_modules.s2_processing import TRANSFER_CONFIG
+import numpy as np
+import os
+
+
+# configure gdal once at module import: a 2GB block cache avoids
+# re-decompressing the same TIFF blocks during warping and the
+# windowed index loop, and skipping directory listings on open
+# avoids redundant readdir syscalls in the many-file data folders
+gdal.SetConfigOption("GDAL_CACHEMAX", "2048")
+gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+gdal.SetConfigOption("VSI_CACHE", "TRUE")
+gdal.SetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
+
+
+# lookup table marking which of the 0-255 scene-class categories are
+# valid surface observations (1-7 and 10 upwards); one table gather
+# per pixel replaces the chained range comparisons
+SCL_VALID = np.zeros(256, dtype = np.uint8)
+SCL_VALID[1:8] = 1
+SCL_VALID[10:] = 1
+
+
+# define compiled helper to quantize an index value to scaled int16
+@njit(inline = "always", cache = True)
+def _quantize(value):
+    """
+    Helper to quantize an index value to the scaled int16 range with
+    scale factor 1e-4; values beyond the representable range saturate
+    at the bounds.
+    """
+    if value < np.float32(-3.2767):
+        value = np.float32(-3.2767)
+    elif value > np.float32(3.2767):
+        value = np.float32(3.2767)
+    return np.int16(np.round(value * np.float32(1e4)))
+
+
+# define compiled kernel to mask bands and calculate all four indices
+@njit(parallel = True, fastmath = True, cache = True)
+def _veg_indices_kernel(scl, b665, b705, b783, b865,
+                        ndvi, wdvi, ndre, ci_re):
+    """
+    Compiled kernel that fuses the scene-class masking, the
+    reflectance scaling and the four vegetation index formulas into
+    one parallel pass over the pixels, writing the four preallocated
+    output arrays in place. The index values are quantized to int16
+    with scale factor 1e-4, the convention used for distributed
+    satellite index products; masked and zero-denominator pixels are
+    set to the -32768 nodata value and out-of-range values saturate,
+    so the windows never need a separate cleanup pass.
+    Function argument(s):
+    - scl: the scene classification band array (uint8)
+    - b665, b705, b783, b865: the optical band arrays with digital
+      numbers in their native uint16 dtype
+    - ndvi, wdvi, ndre, ci_re: preallocated int16 output arrays
+    """
+    for i in prange(scl.shape[0]):
+        for j in range(scl.shape[1]):
+
+            # mask scene-class categories such as cloud cover
+            # (0, 8 and 9) to nodata via the validity lookup table
+            if SCL_VALID[scl[i, j]] == 0:
+                ndvi[i, j] = -32768
+                wdvi[i, j] = -32768
+                ndre[i, j] = -32768
+                ci_re[i, j] = -32768
+                continue
+
+            # convert digital numbers into reflectance values with
+            # the quantification value of 10000
+            r665 = np.float32(b665[i, j]) * np.float32(1e-4)
+            r705 = np.float32(b705[i, j]) * np.float32(1e-4)
+            r783 = np.float32(b783[i, j]) * np.float32(1e-4)
+            r865 = np.float32(b865[i, j]) * np.float32(1e-4)
+
+            # calculate and quantize ndvi
+            ndvi_den = r865 + r665
+            if ndvi_den != 0:
+                ndvi[i, j] = _quantize((r865 - r665) / ndvi_den)
+            else:
+                ndvi[i, j] = -32768
+
+            # calculate and quantize wdvi
+            wdvi[i, j] = _quantize(r865 - np.float32(1.8) * r665)
+
+            # calculate and quantize ndre
+            ndre_den = r865 + r705
+            if ndre_den != 0:
+                ndre[i, j] = _quantize((r865 - r705) / ndre_den)
+            else:
+                ndre[i, j] = -32768
+
+            # calculate and quantize ci_red_edge
+            if r705 != 0:
+                ci_re[i, j] = _quantize(r783 / r705 - np.float32(1.0))
+            else:
+                ci_re[i, j] = -32768
+
+
+def calc_veg_indices(output_path, s2_date, band_names,
+                     veg_indices, tile_index, band_paths):
+    """
+    This function masks the downloaded sentinel-2 bands,
+    calculates a number of vegetation images (NDVI, WDVI, NDRE, CI_Red_Edge)
+    using the s2 bands as input, and stores them in the data output folder.
+    Function argument(s):
+    - output_path: the directory where the sentinel-2 bands are stored
+    - s2_date = the date for which calculations should be performed
+    - band_names: the names of the bands in a list ("scene_class",
+                                                    "surf_refl_665nm",
+                                                    "surf_refl_705nm",
+                                                    "surf_refl_783nm",
+                                                    "surf_refl_865nm")
+    - veg_indices: the names of the vegetation indices
+    - tile_index: the index number of the current tile in the iteration
+    - band_paths: dictionary mapping each band name to its resampled
+      file path, as returned by resample_s2_bands
+    """
+    # open the five resampled band files and keep the datasets open,
+    # so the processing windows below read through the gdal block cache
+    band_files = {}
+    for band_name in band_names:
+        band_files[band_name] = gdal.OpenEx(
+        band_paths[band_name], gdal.OF_RASTER | gdal.OF_READONLY)
+    
+    # set up coordinate reference system and raster dimensions for
+    # the output GeoTIFFs from the SCL band
+    scl_file = band_files["scene_class"]
+    geo_trans = scl_file.GetGeoTransform()
+    proj_info = scl_file.GetProjection()
+    x_pixels = scl_file.RasterXSize
+    y_pixels = scl_file.RasterYSize
+    
+    # create the four output datasets up front as tiled GeoTIFFs, so
+    # the 512x512 processing windows below align with the tile layout
+    driver = gdal.GetDriverByName("GTiff")
+    out_datasets = {}
+    for veg_index in veg_indices:
+        veg_ind_out_file = (f"{output_path}/{veg_index}-"
+                            f"{s2_date}-{tile_index}.tif")
+        
+        # only create datasets for vegetation images that do not
+        # exist; the per-tile outputs are written inside the pooled
+        # compute workers, so the compression stays single-threaded
+        # to keep the worker pinning from main intact
+        if not os.path.isfile(veg_ind_out_file):
+            index_data = driver.Create(utf8_path = veg_ind_out_file,
+                                       xsize = x_pixels,
+                                       ysize = y_pixels,
+                                       bands = 1,
+                                       eType = gdal.GDT_Int16,
+                                       options = ["COMPRESS=ZSTD",
+                                                  "ZSTD_LEVEL=1",
+                                                  "PREDICTOR=2",
+                                                  "TILED=YES",
+                                                  "BLOCKXSIZE=512",
+                                                  "BLOCKYSIZE=512",
+                                                  "NUM_THREADS=1",
+                                                  "BIGTIFF=IF_SAFER"])
+            
+            # set GeoTransform parameters and projection on the
+            # output file, plus the quantization scale and nodata
+            # value so readers restore the physical index values
+            index_data.SetGeoTransform(geo_trans)
+            index_data.SetProjection(proj_info)
+            index_band = index_data.GetRasterBand(1)
+            index_band.SetScale(1e-4)
+            index_band.SetOffset(0.0)
+            index_band.SetNoDataValue(-32768)
+            out_datasets[veg_index] = index_data
+    
+    # stream the rasters through 512x512 windows instead of reading
+    # the five full bands at once; block-sized windows bound the peak
+    # memory to a few small buffers and avoid cache thrashing
+    if out_datasets:
+        block_size = 512
+        for yoff in range(0, y_pixels, block_size):
+            ysize = min(block_size, y_pixels - yoff)
+            for xoff in range(0, x_pixels, block_size):
+                xsize = min(block_size, x_pixels - xoff)
+                
+                # read the current window of all five bands in
+                # their native dtypes (uint8 SCL, uint16 optical);
+                # the kernel dequantizes inline, so no float32
+                # staging copies are made
+                s2_dict = {}
+                for band_name, gdal_file in band_files.items():
+                    s2_dict[band_name] = (gdal_file.GetRasterBand(1).
+                                          ReadAsArray(xoff, yoff,
+                                                      xsize, ysize))
+                
+                # preallocate the four vegetation index windows and
+                # run the fused kernel on the current window
+                veg_ind_dict = {}
+                for veg_index in veg_indices:
+                    veg_ind_dict[veg_index] = np.empty(
+                    (ysize, xsize), dtype = np.int16)
+                _veg_indices_kernel(s2_dict["scene_class"],
+                                    s2_dict["surf_refl_665nm"],
+                                    s2_dict["surf_refl_705nm"],
+                                    s2_dict["surf_refl_783nm"],
+                                    s2_dict["surf_refl_865nm"],
+                                    veg_ind_dict[veg_indices[0]],
+                                    veg_ind_dict[veg_indices[1]],
+                                    veg_ind_dict[veg_indices[2]],
+                                    veg_ind_dict[veg_indices[3]])
+                
+                # write each window to its output dataset; outlier
+                # clamping already happened inside the kernel, so no
+                # cleanup pass with boolean temporaries is needed
+                for veg_index, index_data in out_datasets.items():
+                    (index_data.GetRasterBand(1).
+                     WriteArray(veg_ind_dict[veg_index], xoff, yoff))
+    
+    # build internal overviews on the new outputs, then flush and
+    # close the datasets; downstream viewers read the decimated
+    # levels instead of paying full-resolution I/O
+    for index_data in out_datasets.values():
+        index_data.BuildOverviews("AVERAGE", [2, 4, 8, 16, 32])
+        index_data.FlushCache()
+    out_datasets, band_files, scl_file = None, None, None
+    
+    # remove the resampled band files
+    for band_name in band_names:
+        gdal.Unlink(band_paths[band_name])
+
+
+def mosaic_veg_indices(output_path, s2_date, veg_indices, time_stamp):
+    """
+    Function to merge a number of input rasters into one composite image.
+    Function argument(s):
+    - output_path: the directory where the sentinel-2 bands are stored
+    - s2_date = the date for which calculations should be performed
+    - veg_indices: the names of the vegetation indices in a list
+    - time_stamp: date and time for which calculations were performed
+      (in <YYYY><MM><DD> format)
+    The function returns a dictionary mapping each vegetation index to
+    its mosaic file path.
+    """
+    # walk the output directory tree once and collect the vegetation
+    # index tiles of the current date per index, instead of one
+    # recursive glob stat-walk per index
+    veg_ind_files = {veg_index: [] for veg_index in veg_indices}
+    for dir_path, dir_names, file_names in os.walk(output_path):
+        for file_name in file_names:
+            for veg_index in veg_indices:
+                if (file_name.startswith(f"{veg_index}-{s2_date}-")
+                        and file_name.endswith(".tif")):
+                    veg_ind_files[veg_index].append(
+                    f"{dir_path}/{file_name}")
+    
+    # define helper to mosaic the tiles of one vegetation index
+    def _mosaic_one(veg_index):
+        
+        # select the vegetation index images of the current index
+        veg_ind_in_files = sorted(veg_ind_files[veg_index])
+        
+        # create path names for the geotiff output file and the
+        # in-memory vrt; the vrt only feeds the Translate call, so it
+        # never needs to touch the disk
+        veg_ind_vrt = f"/vsimem/{time_stamp}-{veg_index}.vrt"
+        veg_ind_out_tiff = (f"{output_path}/{time_stamp}-"
+                            f"{veg_index}.tif")
+        
+        # create virtual mosaic from input rasters
+        gdal.BuildVRT(destName = veg_ind_vrt,
+                      srcDSOrSrcDSTab = veg_ind_in_files,
+                      srcNodata = -32768,
+                      VRTNodata = -32768)
+        
+        # store the mosaic as cloud optimized GeoTIFF in output
+        # folder; the COG driver tiles the file and generates the
+        # internal overview levels itself
+        gdal.Translate(destName = veg_ind_out_tiff,
+                       srcDS = veg_ind_vrt,
+                       format = "COG",
+                       creationOptions = ["COMPRESS=ZSTD",
+                                          "LEVEL=1",
+                                          "PREDICTOR=STANDARD",
+                                          "OVERVIEWS=IGNORE_EXISTING",
+                                          "NUM_THREADS=ALL_CPUS",
+                                          "BIGTIFF=IF_SAFER"])
+        
+        # remove the in-memory vrt
+        gdal.Unlink(veg_ind_vrt)
+        return veg_ind_out_tiff
+    
+    # mosaic the four indices concurrently; gdal releases the GIL
+    # during BuildVRT and Translate, so a small thread pool overlaps
+    # the four independent mosaic steps
+    mosaic_paths = {}
+    with ThreadPoolExecutor(max_workers = 4) as executor:
+        for veg_index, veg_ind_out_tiff in zip(
+                veg_indices, executor.map(_mosaic_one, veg_indices)):
+            mosaic_paths[veg_index] = veg_ind_out_tiff
+    
+    # return the mosaic path map
+    return mosaic_paths
+
+
+def upload_veg_indices(config, output_schema, engine, s3,
+                       veg_indices, mosaic_paths):
+    """
+    Function to uplaad calculated vegetation indices to Nexus.
+    Function argument(s):
+    - config: a configuration file
+    - output_schema: the output schema from the Nexus database
+      where the tables are stored
+    - engine: an engine to connect to a sql database
+    - s3: variable for connection with boto3 client
+    - veg_indices: a list with vegetation indices (NDVI, WDVI,
+                                                   NDRE, CI_Red_Edge)
+    - mosaic_paths: dictionary mapping each vegetation index to its
+      mosaic file path, as returned by mosaic_veg_indices
+    """
+    # collect the existing mosaic files
+    upload_files = []
+    for veg_index in veg_indices:
+        file_path = mosaic_paths[veg_index]
+        if os.path.isfile(file_path):
+            upload_files.append(file_path)
+
+    # upload the mosaics concurrently with multi-part transfers; the
+    # uploads are network-bound and release the GIL, so a thread pool
+    # overlaps them
+    with ThreadPoolExecutor(max_workers = 4) as executor:
+        list(executor.map(lambda file_path: s3.upload_file(
+        file_path, config.BUCKET,
+        f"{output_schema}/raster/{os.path.basename(file_path)}",
+        Config = TRANSFER_CONFIG), upload_files))
\ No newline at end of file
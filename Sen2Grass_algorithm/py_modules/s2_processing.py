@@ -1,125 +1,211 @@
-# import modules
-import glob2
-import pandas as pd
-import os
-from osgeo import gdal
-
-
-# define function(s)
-def download_s2_bands(config, input_schema, engine, s3, band_names,
-                      output_path, s2_date, tile_geom):
-    """
-    Function to download sentinel-2 bands and store them in data directory.
-    Function argument(s):
-    - config: a configuration file
-    - input_schema: the input schema from the Nexus database
-      where the tables are stored
-    - engine: an engine to connect to a sql database
-    - s3: variable for connection with boto3 client
-    - band_names: the names of the bands in a list ("scene_class",
-                                                    "surf_refl_665nm",
-                                                    "surf_refl_705nm",
-                                                    "surf_refl_783nm",
-                                                    "surf_refl_865nm")
-    - output_path: the image path where the sentinel-2 bands should be stored
-    - s2_date: the date for which sentinel-2 bands should be downloaded
-    - tile_geom: a polygon geometry string retrieved from table at Nexus server
-    """
-    # define and run first query to extract initial tile id and date
-    tile_query = (f"SELECT id, timestamp "
-                  f"FROM {input_schema}.raster "
-                  f"WHERE parameter LIKE '%%{band_names[0]}%%' and "
-                  f"timestamp::date = '{s2_date}' and "
-                  f"polygon = '{tile_geom}'")
-    
-    # store records in dataframe
-    tile_df = pd.read_sql_query(tile_query, engine)
-    
-    # extract tile id source and timestamp
-    if not tile_df.empty:
-        tile_id = tile_df.iloc[0]["id"]
-        time_stamp = str(tile_df.iloc[0]["timestamp"]).split(" ")[0]
-        time_stamp = (time_stamp.replace("-", ""))
-        
-        # initiate loop to download selected bands
-        for i in range(len(band_names)):
-            
-            # define and run second query to extract selected bands
-            bands_query = (f"SELECT id, parameter "
-                           f"FROM {input_schema}.raster "
-                           f"WHERE id <= {tile_id} and "
-                           f"id >= {tile_id - 11} and "
-                           f"parameter LIKE '%%{band_names[i]}%%' and "
-                           f"timestamp::date = '{s2_date}'")
-            
-            # store records in dataframe
-            bands_df = pd.read_sql_query(bands_query, engine)
-            
-            # set filename and parameter name
-            file_name = f"{str(bands_df.iloc[0]['id'])}"
-            param_name = f"{str(bands_df.iloc[0]['parameter'])}"
-                
-            # set input and output filenames
-            input_file = f"{input_schema}/raster/{file_name}.tif"
-            output_file = f"{output_path}/{param_name}_{s2_date}.tif"
-            
-            # download data
-            if not os.path.isfile(output_file):
-                s3.download_file(config.BUCKET, input_file, output_file)
-                        
-    # else, set tile id and time_stamp to None
-    else:
-        tile_id, time_stamp = None, None
-    
-    # remove variables
-    tile_query, tile_df, bands_query, bands_df = None, None, None, None
-    
-    # return variables
-    return tile_id, time_stamp
-
-
-def resample_s2_bands(output_path, band_names):
-    """
-    Function to resample the downloaded Sentinel-2 bands to 10m.
-    Function argument(s):
-    - output_path: the image path where the sentinel-2 bands are stored
-    - band_names: the names of the bands in a list ("scene_class",
-                                                    "surf_refl_665nm",
-                                                    "surf_refl_705nm",
-                                                    "surf_refl_783nm",
-                                                    "surf_refl_865nm")
-    """
-    # initiate x, y resolution, width and height
-    band_xRes, band_yRes = 10, 10
-    band_width, band_height = 0, 0
-    
-    # initiate loop to perform the resampling
-    for i in range(len(band_names)):
-        
-        # set input and output files
-        input_file = glob2.glob(os.path.join(output_path,
-                                             f"*{band_names[i]}*.tif"))[0]
-        output_file = f"{input_file.split('.tif')[0]}_10m.tif"
-        
-        # set resampling method
-        if "scene_class" in input_file:
-            resample = "near"
-        else:
-            resample = "bilinear"
-        
-        # resample with gdal.Warp
-        if not os.path.isfile(output_file):
-            gdal.Warp(destNameOrDestDS = output_file,
-                      srcDSOrSrcDSTab = input_file,
-                      format = "GTiff",
-                      xRes = band_xRes, yRes = band_yRes,
-                      width = band_width, height = band_height,
-                      resampleAlg = resample,
-                      outputType = gdal.GDT_Float32)
-        
-        # reset x, y, width and height values
-        if i == 0:
-            band_xRes, band_yRes = None, None
-            dims = gdal.Info(glob2.glob(output_file)[0],
-                             format = "json")["size"]
-            band_width, band_height = dims[0], dims[1]
\ No newline at end of file
+# import modules
+from concurrent.futures import ThreadPoolExecutor
+import boto3.s3.transfer
+import pandas as pd
+import os
+import sqlalchemy
+from osgeo import gdal
+
+
+# configure gdal once at module import; see raster_calculations for
+# the rationale behind the block cache and directory-scan settings
+gdal.SetConfigOption("GDAL_CACHEMAX", "2048")
+gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+gdal.SetConfigOption("VSI_CACHE", "TRUE")
+gdal.SetConfigOption("GDAL_NUM_THREADS", "ALL_CPUS")
+
+
+# configure multi-part transfers once at module import; chunks of 16 MB
+# with threaded parts saturate the per-file S3 bandwidth
+TRANSFER_CONFIG = boto3.s3.transfer.TransferConfig(
+multipart_threshold = 8 * 1024 * 1024,
+multipart_chunksize = 16 * 1024 * 1024,
+max_concurrency = 10,
+use_threads = True)
+
+# cache of compiled sql statements, so repeated calls reuse the same
+# statement with bind parameters and the server can reuse its plan
+STMT_CACHE = {}
+
+
+def _cached_stmt(key, query):
+    """
+    Function to compile a sql statement once and reuse it on
+    subsequent calls.
+    Function argument(s):
+    - key: a hashable key identifying the statement
+    - query: the sql query string to compile
+    """
+    if key not in STMT_CACHE:
+        STMT_CACHE[key] = sqlalchemy.text(query)
+    return STMT_CACHE[key]
+
+
+# define function(s)
+def download_s2_bands(config, input_schema, engine, s3, band_names,
+                      output_path, s2_date, tile_geom):
+    """
+    Function to download sentinel-2 bands and store them in data directory.
+    Function argument(s):
+    - config: a configuration file
+    - input_schema: the input schema from the Nexus database
+      where the tables are stored
+    - engine: an engine to connect to a sql database
+    - s3: variable for connection with boto3 client
+    - band_names: the names of the bands in a list ("scene_class",
+                                                    "surf_refl_665nm",
+                                                    "surf_refl_705nm",
+                                                    "surf_refl_783nm",
+                                                    "surf_refl_865nm")
+    - output_path: the image path where the sentinel-2 bands should be stored
+    - s2_date: the date for which sentinel-2 bands should be downloaded
+    - tile_geom: a polygon geometry string retrieved from table at Nexus server
+    The function returns the tile id, the time stamp and a dictionary
+    mapping each band name to its downloaded file path, so downstream
+    steps do not have to glob the data directory again.
+    """
+    # define and run first query to extract initial tile id and date;
+    # the date, geometry and band pattern are passed as bind parameters
+    tile_stmt = _cached_stmt(("tile", input_schema),
+                             f"SELECT id, timestamp "
+                             f"FROM {input_schema}.raster "
+                             f"WHERE parameter LIKE :band_pattern and "
+                             f"timestamp::date = :s2_date and "
+                             f"polygon = :tile_geom")
+
+    # store records in dataframe
+    tile_df = pd.read_sql_query(tile_stmt, engine,
+                                params = {"band_pattern":
+                                          f"%{band_names[0]}%",
+                                          "s2_date": s2_date,
+                                          "tile_geom": tile_geom})
+    
+    # extract tile id source and timestamp
+    if not tile_df.empty:
+        tile_id = tile_df.iloc[0]["id"]
+        time_stamp = str(tile_df.iloc[0]["timestamp"]).split(" ")[0]
+        time_stamp = (time_stamp.replace("-", ""))
+        
+        # define and run second query to extract the records of all
+        # bands in one round-trip instead of one LIKE query per band
+        bands_stmt = _cached_stmt(("bands", input_schema),
+                                  f"SELECT id, parameter "
+                                  f"FROM {input_schema}.raster "
+                                  f"WHERE id <= :max_id and "
+                                  f"id >= :min_id and "
+                                  f"timestamp::date = :s2_date")
+
+        # store records in dataframe
+        bands_df = pd.read_sql_query(bands_stmt, engine,
+                                     params = {"max_id": tile_id,
+                                               "min_id": tile_id - 11,
+                                               "s2_date": s2_date})
+
+        # initiate loop to match each band to its record and collect
+        # the input and output file of each band
+        band_paths = {}
+        download_pairs = []
+        for band_name in band_names:
+
+            # select the record of the current band from the dataframe
+            band_df = bands_df[bands_df["parameter"].
+                               str.contains(band_name)]
+
+            # set filename and parameter name
+            file_name = f"{str(band_df.iloc[0]['id'])}"
+            param_name = f"{str(band_df.iloc[0]['parameter'])}"
+
+            # set input and output filenames
+            input_file = f"{input_schema}/raster/{file_name}.tif"
+            output_file = f"{output_path}/{param_name}_{s2_date}.tif"
+
+            # store output file in path map and collect pair for download
+            band_paths[band_name] = output_file
+            if not os.path.isfile(output_file):
+                download_pairs.append((input_file, output_file))
+
+        # download the bands concurrently; the transfers are network-bound
+        # and release the GIL, so a thread pool overlaps them
+        with ThreadPoolExecutor(max_workers = 8) as executor:
+            list(executor.map(lambda pair: s3.download_file(
+            config.BUCKET, pair[0], pair[1],
+            Config = TRANSFER_CONFIG), download_pairs))
+
+    # else, set tile id, time_stamp and band paths to None
+    else:
+        tile_id, time_stamp, band_paths = None, None, None
+    
+    # remove variables
+    tile_df, bands_df = None, None
+    
+    # return variables
+    return tile_id, time_stamp, band_paths
+
+
+def resample_s2_bands(band_paths):
+    """
+    Function to resample the downloaded Sentinel-2 bands to 10m.
+    The bands are warped into in-memory VRT descriptions instead of
+    on-disk GeoTIFFs; the actual resampling then happens on the fly,
+    per block, while the vegetation index calculation reads the bands.
+    Function argument(s):
+    - band_paths: dictionary mapping each band name to its downloaded
+      file path, as returned by download_s2_bands
+    The function returns a dictionary mapping each band name to its
+    resampled (virtual) file path.
+    """
+    # initiate x, y resolution, width and height
+    band_xRes, band_yRes = 10, 10
+    band_width, band_height = 0, 0
+    
+    # initiate loop to perform the resampling
+    resampled_paths = {}
+    for i, (band_name, input_file) in enumerate(band_paths.items()):
+        
+        # set in-memory output file; the flattened input path keeps
+        # the name unique across concurrently processed tiles
+        output_file = ("/vsimem/" +
+                       input_file.split(".tif")[0].
+                       replace("/", "_").lstrip("_.") + "_10m.vrt")
+        
+        # set resampling method and native output type; keeping the
+        # bands in their storage dtypes (uint8 SCL, uint16 optical)
+        # halves the staging memory and read bandwidth downstream
+        if band_name == "scene_class":
+            resample = "near"
+            output_type = gdal.GDT_Byte
+        else:
+            resample = "bilinear"
+            output_type = gdal.GDT_UInt16
+        
+        # open the source explicitly as a read-only raster and skip
+        # probing for world-file sidecars; the downloaded GeoTIFFs
+        # carry their georeferencing internally
+        input_ds = gdal.OpenEx(input_file,
+                               gdal.OF_RASTER | gdal.OF_READONLY,
+                               open_options = ["GEOREF_SOURCES=INTERNAL"])
+        
+        # build the warped vrt; this only writes resampling metadata,
+        # so it is cheap to (re)create
+        gdal.Warp(destNameOrDestDS = output_file,
+                  srcDSOrSrcDSTab = input_ds,
+                  format = "VRT",
+                  xRes = band_xRes, yRes = band_yRes,
+                  width = band_width, height = band_height,
+                  resampleAlg = resample,
+                  outputType = output_type,
+                  multithread = True,
+                  warpMemoryLimit = 2048)
+        
+        # close the source and store resampled file in path map
+        input_ds = None
+        resampled_paths[band_name] = output_file
+        
+        # reset x, y, width and height values
+        if i == 0:
+            band_xRes, band_yRes = None, None
+            dims = gdal.Info(output_file, format = "json")["size"]
+            band_width, band_height = dims[0], dims[1]
+    
+    # return the resampled path map
+    return resampled_paths
\ No newline at end of file